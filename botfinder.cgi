@@ -4,21 +4,35 @@
 # Purpose: Similar to findBurstTraffic.py, but wrapped up for web access -- try to identify bots that
 #   are sneaking through with traffic to the public server instead of the bot server, identifying
 #   them based on traffic patterns.
+# Notes: The page is served by a WSGI application, which can be run:
+#   1. as a classic CGI script (the default, when this file is executed),
+#   2. as a long-lived FastCGI process (run with the '--fcgi' flag; requires the flup package), or
+#   3. under any WSGI server (eg- mod_wsgi), which should load this file and use 'application'.
+#   In the long-lived modes, the known bot lists, the bot-filtered hits for each day's log file,
+#   and a pool of worker threads are kept across requests, so each request only needs to read
+#   lines appended to the logs since the last one.
 
 import os
 import sys
-sys.path.insert(0, '.')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 import time
-import cgi
+import threading
+import bisect
+import collections
+from array import array
+import concurrent.futures
+import urllib.parse
+import wsgiref.handlers
 from shared import *
 
 ###--- globals ---###
 
 logDir = '/logs/www/public-new'     # where do the log files live?
-endTime = time.time()               # default: one hour of traffic up until now
-startTime = endTime - 3600.0
-error = None
-runBegan = endTime                  # time at which this script's run began
+defaultWindow = 3600.0              # default: one hour of traffic up until now
+maxCachedDays = 3                   # max number of days of bot-filtered hits to keep in memory
+botListMaxAge = 3600.0              # seconds before we re-fetch the lists of known bots
+workerCount = 4                     # number of threads for reading log files in parallel
+outOfOrderMargin = 300.0            # seconds by which a log line's time may precede earlier lines'
 
 ###--- functions ---###
 
@@ -30,23 +44,27 @@ def splitDateTime(dateTime):
         raise Exception('Could not find expected colon in "%s"' % dateTime)
     return (dateTime[:i], dateTime[i+1:])
 
-def handleParameters():
-    global startTime, endTime, error
+def handleParameters(queryString, now):
+    # parse the request's 'queryString' and return (startTime, endTime, error), where the times
+    # default to the hour up until 'now' and 'error' is None if the parameters were valid
+
+    endTime = now
+    startTime = endTime - defaultWindow
 
     sd, st = splitDateTime(toDateTime(startTime))
     ed, et = splitDateTime(toDateTime(endTime))
 
-    fs = cgi.FieldStorage()
+    fs = urllib.parse.parse_qs(queryString)
     for key in list(fs.keys()):
         if key == 'startDate':
-            sd = fs[key].value
+            sd = fs[key][0]
         elif key == 'endDate':
-            ed = fs[key].value
+            ed = fs[key][0]
         elif key == 'startTime':
-            st = fs[key].value
+            st = fs[key][0]
         elif key == 'endTime':
-            et = fs[key].value
-    
+            et = fs[key][0]
+
     try:
         (year, month, day, hour, minute, second) = logFilter.parseDateTime('%s:%s' % (sd, st))
         startTime = logParser.getFloatTime(year, month, day, hour, minute, second)
@@ -54,15 +72,14 @@ def handleParameters():
         (year, month, day, hour, minute, second) = logFilter.parseDateTime('%s:%s' % (ed, et))
         endTime = logParser.getFloatTime(year, month, day, hour, minute, second)
     except Exception as e:
-        error = e
-        return
-    
+        return (now - defaultWindow, now, e)
+
     # ensure that the times are ordered properly
     if startTime > endTime:
         c = endTime
         endTime = startTime
         startTime = c
-    return
+    return (startTime, endTime, None)
 
 def toDateTime(floatTime):
     # convert floatTime (seconds since the epoch) to a string representation of the date/time
@@ -73,9 +90,9 @@ def getMonthDayYear(floatTime):
     s = toDateTime(floatTime)
     return s.split(':')[0].split('/')
 
-def getSelectedDates():
+def getSelectedDates(startTime, endTime):
     # get a list of selected dates (each 'YYYY.mm.dd') that include data from startTime to endTime
-    
+
     secondsPerDay = 60 * 60 * 24
     dates = []
 
@@ -93,25 +110,27 @@ def getSelectedDates():
         nowTuple = (year, month, day)
 
     return dates
-    
-def getLogPaths():
-    # look at the global startTime and endTime and return a list of paths to any relevant log files
-    global error
-    
+
+def getLogPaths(startTime, endTime):
+    # return (list of paths to any log files relevant from startTime to endTime, error), where
+    # 'error' is None unless a log file is missing
+
+    error = None
     dirs = []
-    for ymd in getSelectedDates():
+    for ymd in getSelectedDates(startTime, endTime):
         path = os.path.join(logDir, 'access.log.%s' % ymd)
-        if os.path.exists(path):
-            dirs.append(path)
+        found = logParser.findLogFile(path)
+        if found:
+            dirs.append(found)
         else:
             error = 'Cannot find: %s' % path
             sys.stderr.write(error)
-    return dirs
+    return (dirs, error)
 
-def buildTable(title, tableID, sessions):
+def buildTable(title, tableID, sessions, runBegan):
     # build an output table for the given list of Sessions, headed by the given title
     # returns a single string
-    
+
     out = [
         '<STYLE>',
         '#%s td { border: 1px solid black; max-width:225px; padding: 3px; }' % tableID,
@@ -136,7 +155,7 @@ def buildTable(title, tableID, sessions):
         '</THEAD>',
         '<TBODY>',
         ]
-    
+
     for session in sessions:
         areaCounts = session.getTotalHitsByArea()
         areas = list(areaCounts.keys())
@@ -161,33 +180,32 @@ def buildTable(title, tableID, sessions):
     out.append('</TBODY></TABLE>')
     return '\n'.join(out)
 
-def report(tracker):
-    # build the page of output for the given tracker
-    
+def report(tracker, startTime, endTime, error, runBegan, scriptName = 'botfinder.cgi'):
+    # build the page of output for the given tracker (returned as a single string)
+
     sd, st = splitDateTime(toDateTime(startTime))
     ed, et = splitDateTime(toDateTime(endTime))
 
     errorMessage = ''
     if error:
         errorMessage = '<B>Error: %s</B><P>' % error
-        
+
     out = [
-        'Content-type: text/html',
-        '',
         '<HTML><HEAD><TITLE>botfinder output</TITLE><HEAD><BODY>',
-        '<FORM ACTION="botfinder.cgi" METHOD="GET">',
+        '<FORM ACTION="%s" METHOD="GET">' % scriptName,
         '<H2>botfinder output</H2>',
         '<i>Seeking previously unidentified robots from ',
-        '<INPUT TYPE="text" NAME="startDate" SIZE="10" VALUE="%s" TITLE="start date (mm/dd/yyyy)"> ' % sd, 
-        '<INPUT TYPE="text" NAME="startTime" SIZE="8" VALUE="%s" TITLE="start time (hh:mm:ss)"> ' % st, 
+        '<INPUT TYPE="text" NAME="startDate" SIZE="10" VALUE="%s" TITLE="start date (mm/dd/yyyy)"> ' % sd,
+        '<INPUT TYPE="text" NAME="startTime" SIZE="8" VALUE="%s" TITLE="start time (hh:mm:ss)"> ' % st,
         ' to ',
-        '<INPUT TYPE="text" NAME="endDate" SIZE="10" VALUE="%s" TITLE="end date (mm/dd/yyyy)"> ' % ed, 
-        '<INPUT TYPE="text" NAME="endTime" SIZE="8" VALUE="%s" TITLE="end time (hh:mm:ss)">' % et, 
+        '<INPUT TYPE="text" NAME="endDate" SIZE="10" VALUE="%s" TITLE="end date (mm/dd/yyyy)"> ' % ed,
+        '<INPUT TYPE="text" NAME="endTime" SIZE="8" VALUE="%s" TITLE="end time (hh:mm:ss)">' % et,
         '</i><INPUT TYPE="submit" VALUE="Go"><br/>',
         '<i>Note that time periods longer than 15 hours tend to result in timeouts.<br/>',
         errorMessage,
-        buildTable('Top-50 Most Likely Robot Sessions', 'robotTable', tracker.getMostLikelyRobotSessions(50)),
-        
+        buildTable('Top-50 Most Likely Robot Sessions', 'robotTable', tracker.getMostLikelyRobotSessions(50),
+            runBegan),
+
         '</FORM>',
         # include JQuery libraries
         '<script src="https://ajax.googleapis.com/ajax/libs/jquery/3.3.1/jquery.min.js"></script>',
@@ -203,17 +221,246 @@ def report(tracker):
         '</script>',
     ]
     out.append('</BODY></HTML>')
-    print('\n'.join(out))
-    return
+    return '\n'.join(out)
+
+###--- classes ---###
+
+class CachedHit:
+    # Is: the parts of a LogEntry needed by a SessionTracker, rebuilt from a LogDay's columns
+    # Note: These are only created for the hits in a requested window, and are not kept.
+
+    __slots__ = ('ip', 'time', 'userAgent', 'uriArea')
+
+    def __init__ (self, ip, time, userAgent, uriArea):
+        self.ip = ip
+        self.time = time
+        self.userAgent = userAgent
+        self.uriArea = uriArea
+        return
+
+    def floatTime (self):
+        return self.time
+
+    def area (self):
+        return self.uriArea
+
+class LogDay:
+    # Is: the hits from one day's log file that pass the KnownBotFilter
+    # Has: one column per field (like a Session in sessionTracker.py):  the time of each hit, and
+    #    IDs for its IP address, User-Agent, and area in StringTables shared by the day's hits
+    # Does: reads the file once, then only reads lines appended to it since the last refresh
+    #    (compressed files can't be appended to, so they are re-read only if they change)
+
+    def __init__ (self, path):
+        self.path = path
+        self.signature = None       # (size, modification time) of the file when last read
+        self.lock = threading.Lock()
+        self._reset()
+        return
+
+    def _reset (self):
+        # clear our hits, so the file can be read again from the start
+        self.times = array('d')     # time (in seconds) of each hit, in log order
+        self.ipIds = array('I')     # IP address ID of each hit (parallel to 'times')
+        self.agentIds = array('I')  # User-Agent ID of each hit
+        self.areaIds = array('I')   # area ID of each hit
+        self.ips = sessionTracker.StringTable()
+        self.agents = sessionTracker.StringTable()
+        self.areas = sessionTracker.StringTable()
+        self.offset = 0             # number of bytes of the (uncompressed) file read so far
+        self.badLines = 0           # number of lines read so far that could not be parsed
+        return
+
+    def refresh (self, botFilter):
+        # bring our hits up to date with the log file, using the given 'botFilter'
+        with self.lock:
+            stat = os.stat(self.path)
+            signature = (stat.st_size, stat.st_mtime)
+            if signature == self.signature:
+                return
+
+            compressed = self.path.endswith(tuple(logParser.compressedSuffixes))
+            if compressed or (stat.st_size < self.offset):
+                self._reset()
+
+            if compressed:
+                logParser.LogIterator([self.path], botFilter, self._add, self._countBadLine,
+                    readAhead = logParser.readAheadDepth).go()
+            else:
+                fp = open(self.path, 'rb')
+                try:
+                    fp.seek(self.offset)
+                    logParser.LogIterator([], botFilter, self._add, self._countBadLine).process(
+                        self._newLines(fp))
+                finally:
+                    fp.close()
+            self.signature = signature
+        return
+
+    def track (self, tracker, startTime, endTime):
+        # add our hits from 'startTime' to 'endTime' (inclusive) to the given SessionTracker
+        # Note: Hits are in log order, which is time order apart from lines logged late (eg- for
+        #    slow requests), so we only scan the part of the day found by a binary search for the
+        #    window widened by 'outOfOrderMargin'.
+        with self.lock:
+            first = bisect.bisect_left(self.times, startTime - outOfOrderMargin)
+            last = bisect.bisect_right(self.times, endTime + outOfOrderMargin)
+            for i in range(first, last):
+                if startTime <= self.times[i] <= endTime:
+                    tracker.track(CachedHit(self.ips.getString(self.ipIds[i]), self.times[i],
+                        self.agents.getString(self.agentIds[i]), self.areas.getString(self.areaIds[i])))
+        return
+
+    def _add (self, logEntry):
+        self.times.append(logEntry.floatTime())
+        self.ipIds.append(self.ips.getId(logEntry.ip))
+        self.agentIds.append(self.agents.getId(logEntry.userAgent))
+        self.areaIds.append(self.areas.getId(logEntry.area()))
+        return
+
+    def _countBadLine (self, line):
+        # error handler for lines that cannot be parsed; we just count them here, rather than using
+        # logParser's default handler, whose global counts would grow for the life of the process
+        self.badLines = self.badLines + 1
+        return
+
+    def _newLines (self, fp):
+        # generator for the complete lines in 'fp' from its current position, advancing our offset
+        # past each block of them (text after the last newline may still be being written, so we
+        # leave it for next time)
+        partial = b''
+        block = fp.read(logParser.readBufferSize)
+        while block:
+            lastNewline = block.rfind(b'\n')
+            if lastNewline < 0:
+                partial = partial + block
+            else:
+                data = partial + block[:lastNewline + 1]
+                partial = block[lastNewline + 1:]
+                for line in logParser.decodeLines(data):
+                    yield line
+                self.offset = self.offset + len(data)
+            block = fp.read(logParser.readBufferSize)
+        return
+
+class BotfinderApp:
+    # Is: the WSGI application for the botfinder page
+    # Has: (if 'persistent') the known bot lists, cached LogDay objects, and a pool of worker
+    #    threads, all reused across requests
+
+    def __init__ (self, persistent = True):
+        # constructor; if 'persistent' is False (as for CGI, where we only serve one request) we
+        #    skip the caching and just read the requested window from the log files
+        self.persistent = persistent
+        self.botFilter = None
+        self.botFilterTime = 0.0        # time at which we fetched the bot lists
+        self.days = collections.OrderedDict()  # path -> LogDay, least recently used first
+        self.lock = threading.Lock()
+        self.pool = None
+        if persistent:
+            self.pool = concurrent.futures.ThreadPoolExecutor(workerCount)
+        return
+
+    def __call__ (self, environ, start_response):
+        runBegan = time.time()
+        (startTime, endTime, error) = handleParameters(environ.get('QUERY_STRING', ''), runBegan)
+        (paths, pathError) = getLogPaths(startTime, endTime)
+        error = error or pathError
+
+        tracker = self.findSessions(paths, startTime, endTime)
+        scriptName = os.path.basename(environ.get('SCRIPT_NAME', '')) or 'botfinder.cgi'
+        page = report(tracker, startTime, endTime, error, runBegan, scriptName).encode('utf-8')
+
+        start_response('200 OK', [ ('Content-type', 'text/html'), ('Content-Length', str(len(page))) ])
+        return [ page ]
+
+    def findSessions (self, paths, startTime, endTime):
+        # get a SessionTracker for the (bot-filtered) hits in the given log files, from 'startTime'
+        # to 'endTime'
+        tracker = sessionTracker.SessionTracker()
+        botFilter = self.getBotFilter()
+
+        if not self.persistent:
+            logParser.LogIterator(
+                paths,
+                logFilter.DateFilter(botFilter, toDateTime(startTime), toDateTime(endTime)),
+                tracker.track,
+                readAhead = logParser.readAheadDepth).go()
+            return tracker
+
+        # Only the most recent 'maxCachedDays' days are cached; any earlier ones are read just for
+        # the requested window (while the cached ones are refreshed by the worker threads).
+        firstCached = max(0, len(paths) - maxCachedDays)
+        uncachedPaths = paths[:firstCached]
+        days = self.getDays(paths[firstCached:])
+        futures = [ self.pool.submit(day.refresh, botFilter) for day in days ]
+        if uncachedPaths:
+            logParser.LogIterator(
+                uncachedPaths,
+                logFilter.DateFilter(botFilter, toDateTime(startTime), toDateTime(endTime)),
+                tracker.track,
+                readAhead = logParser.readAheadDepth).go()
+
+        for future in futures:
+            future.result()
+        for day in days:
+            day.track(tracker, startTime, endTime)
+        return tracker
+
+    def getBotFilter (self):
+        # get a KnownBotFilter, re-fetching the bot lists if ours are too old (if that fails, we
+        # keep using the old ones); cached days are dropped if the lists change
+        with self.lock:
+            if self.botFilter and (time.time() - self.botFilterTime < botListMaxAge):
+                return self.botFilter
+            try:
+                botFilter = logFilter.KnownBotFilter()
+            except Exception as e:
+                if not self.botFilter:
+                    raise
+                sys.stderr.write('Keeping old bot lists: %s\n' % e)
+                self.botFilterTime = time.time()
+                return self.botFilter
+
+            if (not self.botFilter) or (botFilter.agentStrings != self.botFilter.agentStrings) \
+                    or (botFilter.ipAddresses != self.botFilter.ipAddresses):
+                self.days = collections.OrderedDict()
+            self.botFilter = botFilter
+            self.botFilterTime = time.time()
+            return self.botFilter
+
+    def getDays (self, paths):
+        # get the LogDay objects for the given paths (no more than 'maxCachedDays' of them), dropping
+        # the least recently used ones beyond 'maxCachedDays'
+        with self.lock:
+            days = []
+            for path in paths:
+                if path not in self.days:
+                    self.days[path] = LogDay(path)
+                self.days.move_to_end(path)
+                days.append(self.days[path])
+
+            while len(self.days) > maxCachedDays:
+                self.days.popitem(last = False)
+            return days
 
 ###--- main program ---###
 
+persistentApp = None                # BotfinderApp shared across requests, created on first use
+persistentAppLock = threading.Lock()
+
+def application(environ, start_response):
+    # WSGI entry point for long-lived servers (mod_wsgi, FastCGI); creates the persistent app on the
+    # first request, so a classic CGI run never builds its caches or worker pool
+    global persistentApp
+    with persistentAppLock:
+        if not persistentApp:
+            persistentApp = BotfinderApp()
+    return persistentApp(environ, start_response)
+
 if __name__ == '__main__':
-    handleParameters()
-
-    tracker = sessionTracker.SessionTracker()
-    logParser.LogIterator(
-        getLogPaths(),
-        logFilter.DateFilter(logFilter.KnownBotFilter(), toDateTime(startTime), toDateTime(endTime)),
-        tracker.track).go()
-    report(tracker)
+    if '--fcgi' in sys.argv[1:]:
+        from flup.server.fcgi import WSGIServer
+        WSGIServer(application).run()
+    else:
+        wsgiref.handlers.CGIHandler().run(BotfinderApp(persistent = False))
@@ -8,12 +8,17 @@ sys.path.insert(0, '/usr/local/mgi/live/lib/python')
 import os
 from shared import *
 
-USAGE = '''Usage: %s <start datetime> <end datetime> <log filename>
+USAGE = '''Usage: %s <start datetime> <end datetime> <log filename> [<sample rate>]
+    sample rate : optional fraction (eg- 0.1) or percentage (eg- 10%%) of IP addresses to sample
 ''' % sys.argv[0]
 
 ###--- Globals ---###
 
-tracker = sessionTracker.SessionTracker()
+sampleRate = 1.0
+if len(sys.argv) > 4:
+    sampleRate = sampling.parseSampleRate(sys.argv[4])
+
+tracker = sessionTracker.SessionTracker(sampleRate = sampleRate)
 
 ###--- Functions ---###
 
@@ -52,5 +57,6 @@ def report():
 logParser.LogIterator(
     [sys.argv[3]],
     logFilter.DateFilter(logFilter.KnownBotFilter(), sys.argv[1], sys.argv[2]),
-    tracker.track).go()
+    tracker.track,
+    sampleRate = sampleRate).go()
 report()
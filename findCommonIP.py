@@ -7,11 +7,16 @@ import sys
 import os
 from shared import *
 
-USAGE = '''Usage: %s <start datetime> <end datetime> <log filename>
+USAGE = '''Usage: %s <start datetime> <end datetime> <log filename> [<sample rate>]
+    sample rate : optional fraction (eg- 0.1) or percentage (eg- 10%%) of IP addresses to sample
 ''' % sys.argv[0]
 
 ###--- Globals ---###
 
+sampleRate = 1.0
+if len(sys.argv) > 4:
+    sampleRate = sampling.parseSampleRate(sys.argv[4])
+
 countByIP = {}
 agentByIP = {}
 
@@ -26,19 +31,31 @@ def ipTracker(entry):
         agentByIP[ip] = entry.userAgent
     return
 
-def countCompare(ab):
+def countCompare(a):
     return (a[1], a[0])
 
 def report():
     items = list(countByIP.items())
-    items.sort(key=countCompare)
+    items.sort(key=countCompare, reverse=True)
     for (ip, count) in items[:15]:
         print('%10d %s %s' % (count, ip, agentByIP[ip]))
     print()
-    print('%d lines could not be parsed; common offenders:' % logParser.getFaultyLineCount())
+    if sampleRate < 1.0:
+        # counts for each sampled IP are exact (all their hits are kept); totals are estimates
+        print('Sampled %0.1f%% of IP addresses; counts above are exact for each sampled IP' % (100.0 * sampleRate))
+        print('Estimated total hits: %s' % sampling.formatEstimate(
+            *sampling.estimateTotal(list(countByIP.values()), sampleRate)))
+        print('Estimated distinct IPs: %s' % sampling.formatEstimate(
+            *sampling.estimateTotal([1] * len(countByIP), sampleRate)))
+        print()
+    if sampleRate < 1.0:
+        # unparsable lines are only counted for sampled IPs, so say so
+        print('%d lines from sampled IPs could not be parsed; common offenders:' % logParser.getFaultyLineCount())
+    else:
+        print('%d lines could not be parsed; common offenders:' % logParser.getFaultyLineCount())
     
     items = logParser.getFaultyLineSources()
-    items.sort(key=countCompare)
+    items.sort(key=countCompare, reverse=True)
     for (ip, count) in items[:15]:
         print('%10d %s' % (count, ip))
     
@@ -49,5 +66,6 @@ def report():
 logParser.LogIterator(
     [sys.argv[3]],
     logFilter.DateFilter(None, sys.argv[1], sys.argv[2]),
-    ipTracker).go()
+    ipTracker,
+    sampleRate = sampleRate).go()
 report()
@@ -7,13 +7,18 @@ import sys
 import os
 from shared import *
 
-USAGE = '''Usage: %s <start datetime> <end datetime> <log filename>
+USAGE = '''Usage: %s <start datetime> <end datetime> <log filename> [<sample rate>]
+    sample rate : optional fraction (eg- 0.1) or percentage (eg- 10%%) of IP addresses to sample
 ''' % sys.argv[0]
 
 ###--- Globals ---###
 
 countByUserAgent = {}
-ipByAgent = {}
+ipByAgent = {}              # user agent -> { IP address : count of hits }
+
+sampleRate = 1.0
+if len(sys.argv) > 4:
+    sampleRate = sampling.parseSampleRate(sys.argv[4])
 
 ###--- Functions ---###
 
@@ -21,7 +26,10 @@ def uaTracker(entry):
     ua = entry.userAgent
     if ua in countByUserAgent:
         countByUserAgent[ua] = 1 + countByUserAgent[ua]
-        ipByAgent[ua][entry.ip] = 1
+        if entry.ip in ipByAgent[ua]:
+            ipByAgent[ua][entry.ip] = 1 + ipByAgent[ua][entry.ip]
+        else:
+            ipByAgent[ua][entry.ip] = 1
     else:
         countByUserAgent[ua] = 1
         ipByAgent[ua] = { entry.ip : 1 }
@@ -49,9 +57,18 @@ def commonIpPrefix(ipSet):
 
 def report():
     items = list(countByUserAgent.items())
-    items.sort(key=countCompare)
+    items.sort(key=countCompare, reverse=True)
     print('Top 25 Hitters per User-Agent:')
     print('------------------------------')
+    if sampleRate < 1.0:
+        # scale each count up from the sampled IPs, with a 95% confidence interval
+        print('(estimated from a %0.1f%% sample of IP addresses)' % (100.0 * sampleRate))
+        for (agent, count) in items[:25]:
+            estimate = sampling.estimateTotal(list(ipByAgent[agent].values()), sampleRate)
+            print('%24s %s %s' % (sampling.formatEstimate(*estimate),
+                commonIpPrefix(list(ipByAgent[agent].keys())), agent))
+        return
+
     for (agent, count) in items[:25]:
         print('%10d %s %s' % (count, commonIpPrefix(list(ipByAgent[agent].keys())), agent))
     return
@@ -61,5 +78,6 @@ def report():
 logParser.LogIterator(
     [sys.argv[3]],
     logFilter.DateFilter(None, sys.argv[1], sys.argv[2]),
-    uaTracker).go()
+    uaTracker,
+    sampleRate = sampleRate).go()
 report()
@@ -1,5 +1,6 @@
 __all__ = [
 	"logFilter",
 	"logParser",
+	"sampling",
 	"sessionTracker",
 ]
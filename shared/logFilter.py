@@ -1,7 +1,7 @@
 # Name: logFilter.py
 # Purpose: library for filtering LogEntry objects (defined in logParser.py)
 
-from .logParser import getFloatTime
+from .logParser import getFloatTime, getMinuteFloatTime, getArea, getRawIP, getRawMinute, getRawURI, getRawUserAgent
 import time
 import re
 import sys
@@ -17,6 +17,7 @@ dateTimeRE = re.compile(
 
 startTime = time.time()
 halfHour = 60 * 30
+maxCachedMinutes = 10000    # limit on DateFilter's cache of parsed minutes
 
 ###--- Functions ---###
 
@@ -48,6 +49,8 @@ class LogFilter:
     #    another, and so on.  Each filter is evaluated before the filter it contains, as
     #    it only passes to the chained one if this one passes. Each LogFilter subclass
     #    should only need to implement the _test() method for its particular test.
+    #    Subclasses may also implement _prescreen(), a cheaper test on the raw line which lets
+    #    the LogIterator skip parsing lines that are sure to fail.
 
     def __init__ (self, innerFilter = None):
         # Purpose: constructor; initializes this LogFilter and (optionally) includes another
@@ -63,12 +66,28 @@ class LogFilter:
             return True
         return False
     
+    def prescreen (self, line):
+        # Purpose: to determine if the raw log 'line' could pass this filter and its chained ones
+        # Returns: False if the line would certainly fail passes(), True if it might pass
+        if self._prescreen(line):
+            if self.innerFilter and not self.innerFilter.prescreen(line):
+                return False
+            return True
+        return False
+    
     def _test (self, logEntry):
         # Purpose: to determine if the logEntry passes this particular filter
         # Note: The base LogFilter class is just a pass-through; everything passes the filter.
         #    Subclasses should implement this method to handle particular criteria.
         return True
 
+    def _prescreen (self, line):
+        # Purpose: to determine cheaply (without parsing it into a LogEntry) if the raw 'line'
+        #    could pass this particular filter
+        # Note: This must only return False for lines that _test() would reject; if in doubt,
+        #    return True and let _test() decide.  The base LogFilter passes everything.
+        return True
+
 class DateFilter (LogFilter):
     # Is: a filter that filters LogEntry objects by request date & time.
 
@@ -82,6 +101,7 @@ class DateFilter (LogFilter):
         self.innerFilter = innerFilter
         self.startFloatTime = None
         self.endFloatTime = None
+        self.minuteCache = {}           # maps "dd/mmm/yyyy:HH:MM" from a raw line -> float time
         
         if startDateTime:
             (year, month, day, hour, minute, second) = parseDateTime(startDateTime)
@@ -101,6 +121,24 @@ class DateFilter (LogFilter):
             return False
         return True
     
+    def _prescreen(self, line):
+        # Lines come in time order, so only a few distinct minutes need to be parsed; a line fails
+        # if its whole minute falls outside the requested range.
+        minute = getRawMinute(line)
+        if minute not in self.minuteCache:
+            if len(self.minuteCache) >= maxCachedMinutes:
+                self.minuteCache = {}
+            self.minuteCache[minute] = getMinuteFloatTime(minute) if minute else None
+        
+        minuteTime = self.minuteCache[minute]
+        if minuteTime == None:
+            return True
+        if self.startFloatTime and (minuteTime + 60 < self.startFloatTime):
+            return False
+        if self.endFloatTime and (minuteTime > self.endFloatTime):
+            return False
+        return True
+    
 class KnownBotFilter (LogFilter):
     # Is: a filter that filters out LogEntry objects for already-known robots
     
@@ -108,6 +146,7 @@ class KnownBotFilter (LogFilter):
         self.innerFilter = innerFilter
         self.agentStrings = []          # list of User-Agent strings to filter out
         self.ipAddresses = set()        # list of IP addresses to filter out
+        self.agentRE = None             # compiled regex matching any of the agentStrings
         self._initialize()
         return 
 
@@ -131,13 +170,57 @@ class KnownBotFilter (LogFilter):
                 [ key, values ] = line.split('=')
                 for value in values.split(','):
                     self.ipAddresses.add(value.strip())
+
+        if self.agentStrings:
+            self.agentRE = re.compile('|'.join([ re.escape(key) for key in self.agentStrings ]))
         return
         
     def _test(self, logEntry):
         if logEntry.ip in self.ipAddresses:
             return False
         
-        for key in self.agentStrings:
-            if logEntry.userAgent.find(key) >= 0:
+        if self.agentRE and self.agentRE.search(logEntry.userAgent):
+            return False
+        return True
+
+    def _prescreen(self, line):
+        if getRawIP(line) in self.ipAddresses:
+            return False
+        
+        if self.agentRE:
+            userAgent = getRawUserAgent(line)
+            if (userAgent != None) and self.agentRE.search(userAgent):
                 return False
         return True
+
+class AreaFilter (LogFilter):
+    # Is: a filter that filters LogEntry objects by the area of their requested URI (see
+    #    LogEntry.area(), eg- to leave out requests for static assets)
+
+    def __init__ (self, innerFilter = None, includeAreas = None, excludeAreas = None):
+        # Note:  If 'includeAreas' is specified, only LogEntry objects for those areas will pass.
+        #    Any LogEntry objects for areas in 'excludeAreas' will fail.
+        self.innerFilter = innerFilter
+        self.includeAreas = None
+        self.excludeAreas = None
+        if includeAreas:
+            self.includeAreas = set(includeAreas)
+        if excludeAreas:
+            self.excludeAreas = set(excludeAreas)
+        return
+
+    def _areaPasses(self, area):
+        if self.includeAreas and (area not in self.includeAreas):
+            return False
+        if self.excludeAreas and (area in self.excludeAreas):
+            return False
+        return True
+
+    def _test(self, logEntry):
+        return self._areaPasses(logEntry.area())
+
+    def _prescreen(self, line):
+        uri = getRawURI(line)
+        if uri == None:
+            return True
+        return self._areaPasses(getArea(uri))
@@ -4,6 +4,22 @@
 import time
 import re
 import sys
+import io
+import os
+import gzip
+import bz2
+import lzma
+import queue
+import threading
+from . import sampling
+
+try:
+    from compression import zstd        # standard library as of Python 3.14
+except ImportError:
+    try:
+        import zstandard as zstd        # optional third-party package for older Pythons
+    except ImportError:
+        zstd = None
 
 ###--- Globals ---###
 
@@ -33,6 +49,12 @@ months = {
 badLineCount = 0
 badLineSource = {}      # counts by requesting IP
 
+# suffixes for compressed (rotated) log files, in the order we look for them
+compressedSuffixes = [ '.gz', '.bz2', '.xz', '.zst' ]
+
+readBufferSize = 1024 * 1024    # bytes read at a time from a log file (compressed or not)
+readAheadDepth = 8              # max number of blocks a LogPrefetcher may read ahead of its consumer
+
 ###--- Functions ---###
 
 def defaultErrorHandler(line):
@@ -63,8 +85,263 @@ def getFloatTime(year, month, day, hour, minute, second):
     timeStruct = (year, month, day, hour, minute, second, 0, 0, -1)
     return time.mktime(timeStruct)
 
+def getArea(uri):
+    # get the major area for the given requested URI (eg- 'marker', 'allele', etc.)
+    if uri:
+        pieces = uri.split('/')
+        if len(pieces) >= 2:
+            area = pieces[1]
+            q = area.find('?')
+            if q >= 0:
+                return area[:q]
+            return area 
+    return 'N/A'
+
+# The getRaw*() functions below pull single fields out of a raw log line without a full parse, so
+# LogFilters can prescreen lines cheaply.  Each returns None if it cannot be sure of its field; a
+# line that parses into a LogEntry has exactly six double-quotes (around the request, referrer, and
+# user agent), so we don't trust the quotes in any other line.
+
+def getRawIP(line):
+    # get the requesting IP address from a raw log line
+    return line[:line.find(' ')]
+
+def getRawMinute(line):
+    # get the date/time from a raw log line, to the minute (as "dd/mmm/yyyy:HH:MM")
+    i = line.find('[')
+    if i < 0:
+        return None
+    return line[i+1:i+18]
+
+def getRawURI(line):
+    # get the requested URI from a raw log line
+    if line.count('"') != 6:
+        return None
+    request = line.split('"', 2)[1].split(' ')
+    if len(request) < 2:
+        return None
+    return request[1]
+
+def getRawUserAgent(line):
+    # get the User-Agent from a raw log line
+    if line.count('"') != 6:
+        return None
+    return line.split('"')[5]
+
+def getMinuteFloatTime(minute):
+    # get the time in seconds since the epoch for 'minute' (formatted "dd/mmm/yyyy:HH:MM"), or None
+    # if it cannot be parsed
+    try:
+        (day, month, rest) = minute.split('/')
+        (year, hour, minute) = rest.split(':')
+        return getFloatTime(int(year), getNumericMonth(month), int(day), int(hour), int(minute), 0)
+    except:
+        return None
+
+def findLogFile(path):
+    # Purpose: find the log file at 'path' or, failing that, a compressed variant of it (eg- with
+    #    a '.gz' suffix)
+    # Returns: path to the file found, or None if there is none
+    for suffix in [ '' ] + compressedSuffixes:
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return None
+
+def openRawLog(filename, bufferSize = readBufferSize):
+    # Purpose: open the given log file for reading as bytes, transparently decompressing it if its
+    #    name ends in one of the compressedSuffixes
+    # Returns: a BlockReader for the (decompressed) contents of the file
+    # Notes: Both the file and the decompressed stream are read in blocks of 'bufferSize' bytes.
+    #    (To decompress ahead of the reader in a separate thread, use a LogPrefetcher.)
+    # Throws: Exception if 'filename' is '.zst' and no zstd module is available
+    fp = open(filename, 'rb', buffering = bufferSize)
+    try:
+        if filename.endswith('.gz'):
+            source = gzip.GzipFile(fileobj = fp)
+        elif filename.endswith('.bz2'):
+            source = bz2.BZ2File(fp)
+        elif filename.endswith('.xz'):
+            source = lzma.LZMAFile(fp)
+        elif filename.endswith('.zst'):
+            if zstd is None:
+                raise Exception('Cannot read %s: no zstd module available' % filename)
+            if hasattr(zstd, 'ZstdFile'):
+                source = zstd.ZstdFile(fp)
+            else:
+                source = zstd.ZstdDecompressor().stream_reader(fp, read_across_frames = True)
+        else:
+            source = fp
+    except:
+        fp.close()
+        raise
+
+    return BlockReader(source, fp, bufferSize)
+
+def decodeLines(data):
+    # Purpose: decode the given bytes (a series of complete lines) into an iterator over lines
+    # Notes: uses universal newlines, the same as text files opened by openLog(), so "\r\n" and a
+    #    bare "\r" also end a line (and are returned as "\n")
+    return io.StringIO(data.decode('utf-8', 'replace'), newline = None)
+
+def openLog(filename, bufferSize = readBufferSize):
+    # Purpose: open the given log file for reading as text (see openRawLog() for parameters)
+    reader = openRawLog(filename, bufferSize)
+    return io.TextIOWrapper(io.BufferedReader(reader, bufferSize), encoding = 'utf-8', errors = 'replace')
+
 ###--- Classes ---###
 
+class BlockReader (io.RawIOBase):
+    # Is: a raw binary stream that reads large blocks from a source stream (eg- a decompressor)
+    # Has: the source stream and the underlying file, which are closed together
+
+    def __init__ (self, source, fp, blockSize = readBufferSize):
+        # Purpose: constructor; 'source' is read in blocks of 'blockSize' bytes, and 'fp' is the
+        #    underlying file (which may be the same object as 'source')
+        self.source = source
+        self.fp = fp
+        self.blockSize = blockSize
+        self.pending = memoryview(b'')  # current block, not yet fully consumed
+        self.offset = 0                 # position of next unconsumed byte in 'pending'
+        self.atEnd = False
+        return
+
+    def readable (self):
+        return True
+
+    def readinto (self, buffer):
+        # Purpose: fill as much of 'buffer' as we can from the current block (reading the next one
+        #    if needed)
+        # Returns: number of bytes copied into 'buffer' (0 at end of file)
+        if self.offset >= len(self.pending):
+            if self.atEnd:
+                return 0
+            self.pending = memoryview(self.source.read(self.blockSize))
+            self.offset = 0
+            if not self.pending:
+                self.atEnd = True
+                return 0
+
+        count = min(len(buffer), len(self.pending) - self.offset)
+        buffer[:count] = self.pending[self.offset:self.offset + count]
+        self.offset = self.offset + count
+        return count
+
+    def readBlock (self):
+        # Purpose: read the rest of the current block (or the next one), without copying it
+        # Returns: bytes, or an empty bytes object at end of file
+        if self.offset < len(self.pending):
+            block = self.pending[self.offset:].tobytes()
+            self.offset = len(self.pending)
+            return block
+        if self.atEnd:
+            return b''
+        block = self.source.read(self.blockSize)
+        if not block:
+            self.atEnd = True
+        return block
+
+    def close (self):
+        if not self.closed:
+            if self.source is not self.fp:
+                self.source.close()
+            self.fp.close()
+        io.RawIOBase.close(self)
+        return
+
+
+class LogPrefetcher:
+    # Is: a pipelined reader for the lines of a list of log files
+    # Does: reads (and decompresses) large blocks from each file in a background thread, queueing up
+    #    to 'depth' blocks ahead of the consumer, so disk & network I/O overlap with parsing.  The
+    #    consumer just iterates over lines, which continue seamlessly from one file to the next.
+
+    endOfFile = 'EOF'           # queue marker for the end of one file (may end with a partial line)
+    endOfFiles = 'DONE'         # queue marker for the end of the last file
+
+    def __init__ (self, filenames, depth = readAheadDepth, blockSize = readBufferSize):
+        self.filenames = filenames
+        self.depth = depth
+        self.blockSize = blockSize
+        self.stopped = False
+        self.queue = None
+        self.thread = None
+        return
+
+    def __iter__ (self):
+        # Purpose: start the background thread and iterate over lines (as strings, including their
+        #    trailing newlines) from all the files in order
+        # Throws: any Exception raised while opening or reading a file
+        self.stopped = False
+        self.queue = queue.Queue(self.depth)
+        self.thread = threading.Thread(target = self._fill, daemon = True)
+        self.thread.start()
+
+        try:
+            partial = b''           # last (unterminated) line from the previous block
+            while True:
+                block = self.queue.get()
+                if block is self.endOfFiles:
+                    break
+                elif block is self.endOfFile:
+                    if partial:
+                        yield partial.decode('utf-8', 'replace')
+                    partial = b''
+                    continue
+                elif isinstance(block, Exception):
+                    raise block
+
+                # only decode through the last newline, so a multi-byte character or a line is
+                # never split across blocks
+                lastNewline = block.rfind(b'\n')
+                if lastNewline < 0:
+                    partial = partial + block
+                    continue
+                lines = decodeLines(partial + block[:lastNewline + 1])
+                partial = block[lastNewline + 1:]
+                for line in lines:
+                    yield line
+        finally:
+            self.close()
+        return
+
+    def _fill (self):
+        # runs in the background thread; reads blocks from each file in turn
+        try:
+            for filename in self.filenames:
+                reader = openRawLog(filename, self.blockSize)
+                try:
+                    block = reader.readBlock()
+                    while block:
+                        if not self._put(block):
+                            return
+                        block = reader.readBlock()
+                finally:
+                    reader.close()
+                if not self._put(self.endOfFile):
+                    return
+            self._put(self.endOfFiles)
+        except Exception as e:
+            self._put(e)
+        return
+
+    def _put (self, item):
+        # add 'item' to the queue, waiting for space; returns False if we were closed while waiting
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def close (self):
+        # stop the background thread (if the consumer quits early) and wait for it to finish
+        self.stopped = True
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        return
+
 class LogEntry:
     # Is: an entry from an Apache access log
     # Has: various fields about the request, its date/time, the requesting IP address, etc.
@@ -119,15 +396,7 @@ class LogEntry:
     
     def area(self):
         # get the major area for the requested URL (eg- 'marker', 'allele', etc.)
-        if self.uri:
-            pieces = self.uri.split('/')
-            if len(pieces) >= 2:
-                area = pieces[1]
-                q = area.find('?')
-                if q >= 0:
-                    return area[:q]
-                return area 
-        return 'N/A'
+        return getArea(self.uri)
 
     def floatTime(self):
         # get the date/time as a number of seconds since the epoch (cache once computed)
@@ -161,20 +430,31 @@ class LogIterator:
     # Is: an iterator to go through & help process log entries
     # Does: handles iteration across files and reading of each file
     
-    def __init__ (self, inputFilenames, logFilter, entryHandler, errorHandler = None):
+    def __init__ (self, inputFilenames, logFilter, entryHandler, errorHandler = None, sampleRate = 1.0,
+            readAhead = 0, blockSize = readBufferSize):
         # Purpose: constructor
         # Notes: This object will:
         #    1. will iterate through the given filenames
         #    2. will read each line in each file
-        #    3. will create a LogEntry object from each line
+        #    3. will create a LogEntry object from each line that passes the logFilter's prescreen
         #       a. if #3 fails, then will pass the input line to the errorHandler function
         #       b. otherwise continue to #4
         #    4. see if the LogEntry is passed by the logFilter
         #    5. if so, pass the LogEntry to the entryHandler function
         #       a. if not, continue with next line in #2
         # If 'errorHandler' is None, we will use the default errorHandler() function, which
-        # simply counts lines with errors.
+        # simply counts lines with errors.  (Lines rejected by the prescreen are counted as
+        # discarded, even if they could not have been parsed.)
+        # If 'sampleRate' is less than 1.0, only lines from a deterministic hash-based sample of
+        # IP addresses (see sampling.py) are processed.  The IP is checked before #3, so lines
+        # from unsampled IPs are skipped after reading only the first field.
+        # Compressed log files (see compressedSuffixes) are decompressed as they are read.  If
+        # 'readAhead' is greater than zero, that reading (and decompression) is done in a separate
+        # thread by a LogPrefetcher, which stays up to 'readAhead' blocks of 'blockSize' bytes
+        # ahead of #3-5.
         self.inputFilenames = inputFilenames
+        self.readAhead = readAhead
+        self.blockSize = blockSize
         self.entryHandler = entryHandler
         self.logFilter = logFilter
         self.errorHandler = errorHandler
@@ -184,31 +464,61 @@ class LogIterator:
         self.failed = 0
         self.kept = 0
         self.discarded = 0
+        self.unsampled = 0
         self.elapsedTime = 0.0
+        self.sampleRate = sampleRate
+        self.sampleThreshold = sampling.getThreshold(sampleRate)
         return
     
     def go (self):
         # Purpose: sets this iterator to work, processing according to the Notes in the constructor
         # Notes: will return once all lines of all input filenames have been processed
+        self.process(self._lines())
+        return
+    
+    def process (self, lines):
+        # Purpose: process the given iterable of lines (rather than those from our input files),
+        #    according to steps 3-5 in the constructor's Notes
+        # Notes: may be called repeatedly (eg- for lines newly appended to a log file); counts and
+        #    'elapsedTime' accumulate across calls
         
         startTime = time.time() 
+        sampled = self.sampleRate < 1.0
+        for line in lines:
+            self.read = self.read + 1
+            if sampled and not sampling.isSampled(getRawIP(line), self.sampleThreshold):
+                self.unsampled = self.unsampled + 1
+                continue
+            try:
+                if not self.logFilter.prescreen(line):
+                    self.discarded = self.discarded + 1
+                    continue
+                logEntry = LogEntry(line)
+                if self.logFilter.passes(logEntry):
+                    self.entryHandler(logEntry)
+                    self.kept = self.kept + 1
+                else:
+                    self.discarded = self.discarded + 1
+            except:
+                self.errorHandler(line)
+                self.failed = self.failed + 1
+
+        self.elapsedTime = self.elapsedTime + time.time() - startTime
+        return
+    
+    def _lines (self):
+        # Purpose: generator for the lines of all input files, in order (either read directly or
+        #    through a LogPrefetcher, depending on 'readAhead')
+        if self.readAhead > 0:
+            for line in LogPrefetcher(self.inputFilenames, self.readAhead, self.blockSize):
+                yield line
+            return
+
         for filename in self.inputFilenames:
-            fp = open(filename, 'r')
-            line = fp.readline()
-            while line:
-                self.read = self.read + 1
-                try:
-                    logEntry = LogEntry(line)
-                    if self.logFilter.passes(logEntry):
-                        self.entryHandler(logEntry)
-                        self.kept = self.kept + 1
-                    else:
-                        self.discarded = self.discarded + 1
-                except:
-                    self.errorHandler(line)
-                    self.failed = self.failed + 1
-                line = fp.readline()
-            fp.close()
-
-        self.elapsedTime = time.time() - startTime
+            fp = openLog(filename, self.blockSize)
+            try:
+                for line in fp:
+                    yield line
+            finally:
+                fp.close()
         return
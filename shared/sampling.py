@@ -0,0 +1,68 @@
+# Name: sampling.py
+# Purpose: library for deterministic, hash-based sampling of requesting IP addresses, and for
+#   scaling counts from such a sample back up to estimates (with confidence intervals) for the
+#   full set of log entries.
+# Notes: Sampling is done by IP address rather than by line, so every hit from a sampled IP is
+#   kept and its sessions stay intact.  The hash is a CRC32 of the IP address, so the same IPs are
+#   chosen on every run (and for every log file) for a given sample rate.
+
+import zlib
+import math
+
+###--- Globals ---###
+
+hashSpace = 2 ** 32         # CRC32 values fall in [0, hashSpace)
+z95 = 1.96                  # z-score for a 95% confidence interval
+
+###--- Functions ---###
+
+def getThreshold(sampleRate):
+    # Purpose: convert a 'sampleRate' (0.0 < sampleRate <= 1.0) into the hash threshold used by
+    #    isSampled()
+    # Throws: Exception if 'sampleRate' is out of range
+    if (sampleRate <= 0.0) or (sampleRate > 1.0):
+        raise Exception('Invalid sample rate (must be > 0.0 and <= 1.0): %s' % sampleRate)
+    return int(sampleRate * hashSpace)
+
+def isSampled(ip, threshold):
+    # Purpose: determine whether the given 'ip' (a string) falls in the sample defined by
+    #    'threshold' (as returned by getThreshold())
+    return zlib.crc32(ip.encode('utf-8')) < threshold
+
+def parseSampleRate(value):
+    # Purpose: parse a sample rate from a command-line string; accepts either a fraction (eg- "0.1")
+    #    or a percentage (eg- "10%")
+    # Throws: Exception if 'value' cannot be parsed or is out of range
+    value = value.strip()
+    try:
+        if value.endswith('%'):
+            rate = float(value[:-1]) / 100.0
+        else:
+            rate = float(value)
+    except ValueError:
+        raise Exception('Cannot parse sample rate: %s' % value)
+    getThreshold(rate)          # validate range
+    return rate
+
+def estimateTotal(perIpCounts, sampleRate):
+    # Purpose: estimate a population total from the counts observed for each sampled IP address
+    # Returns: (estimate, halfWidth) where the 95% confidence interval is estimate +/- halfWidth
+    # Notes: 'perIpCounts' is an iterable of the counts contributed by each sampled IP.  Each IP is
+    #    included independently with probability 'sampleRate', so this is the Horvitz-Thompson
+    #    estimator, with variance estimated as (1 - p) / p^2 * sum(count^2).  With a 'sampleRate'
+    #    of 1.0 the estimate is exact and 'halfWidth' is 0.0.
+    total = 0
+    sumOfSquares = 0
+    for count in perIpCounts:
+        total = total + count
+        sumOfSquares = sumOfSquares + count * count
+
+    estimate = total / sampleRate
+    variance = (1.0 - sampleRate) / (sampleRate * sampleRate) * sumOfSquares
+    return (estimate, z95 * math.sqrt(variance))
+
+def formatEstimate(estimate, halfWidth):
+    # Purpose: format an (estimate, halfWidth) pair for reporting
+    if halfWidth == 0.0:
+        return '%d' % round(estimate)
+    return '~%d (+/- %d)' % (round(estimate), round(halfWidth))
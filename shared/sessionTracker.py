@@ -4,6 +4,8 @@
 
 import sys
 import math
+from array import array
+from . import sampling
 
 def endSlice(myList, num):
     # assumes myList is sorted in ascending order.  Returns the last 'num' items in
@@ -21,17 +23,42 @@ def scale (measurement):
         return 0.0
     return math.log(measurement)
 
+class StringTable:
+    # Is: a table of interned strings, each identified by a small integer ID
+    # Does: lets many Session objects refer to the same (often long) string, like a User-Agent,
+    #    by storing just its ID
+
+    def __init__ (self):
+        self.idsByString = {}       # string -> integer ID
+        self.strings = []           # list of strings, indexed by ID
+        return
+
+    def getId (self, string):
+        # get the ID for 'string', assigning a new one if we haven't seen it before
+        if string not in self.idsByString:
+            self.idsByString[string] = len(self.strings)
+            self.strings.append(string)
+        return self.idsByString[string]
+
+    def getString (self, stringId):
+        # get the string for the given ID
+        return self.strings[stringId]
+
 class SessionTracker:
     # Is: a tracker that helps sort LogEntry objects into appropriate sessions
     # Has: sets of Session objects, each with data about their LogEntry objects
     
-    def __init__ (self, maxGap = 300):
+    def __init__ (self, maxGap = 300, sampleRate = 1.0):
         # constructor; 'maxGap' defines how large a gap of seconds is allowed between hits of
-        #    a single Session
+        #    a single Session; 'sampleRate' is the fraction of IP addresses that were sampled by
+        #    the LogIterator feeding this tracker (used to scale counts up to estimates)
         self.activeSessions = {}        # IP address -> Session object
         self.oldSessions = []           # list of Session o bjects that are no longer active
         self.maxGap = maxGap
+        self.sampleRate = sampleRate
         self.latestTime = 0.0           # latest time we've seen so far
+        self.areas = StringTable()      # data areas, shared by all Session objects
+        self.agents = StringTable()     # User-Agent strings, shared by all Session objects
         return
     
     def track(self, entry):
@@ -41,11 +68,11 @@ class SessionTracker:
             # We've seen this IP address before, but this entry is after its gap expired, so retire
             # the old session and start a new one.
             self.oldSessions.append(self.activeSessions[entry.ip])
-            self.activeSessions[entry.ip] = Session(self.maxGap)
+            self.activeSessions[entry.ip] = Session(self.maxGap, self.areas, self.agents)
 
         elif (entry.ip not in self.activeSessions):
             # We haven't seen this IP address before, so it's definitely a new session.
-            self.activeSessions[entry.ip] = Session(self.maxGap)
+            self.activeSessions[entry.ip] = Session(self.maxGap, self.areas, self.agents)
             
         self.activeSessions[entry.ip].add(entry)
         self.latestTime = max(self.latestTime, entry.floatTime())
@@ -61,6 +88,9 @@ class SessionTracker:
     def report(self):
         print('Active Sessions: %d' % len(self.activeSessions))
         print('Old Sessions: %d' % len(self.oldSessions))
+        if self.sampleRate < 1.0:
+            print('Estimated Sessions (%0.1f%% IP sample): %s' % (100.0 * self.sampleRate,
+                sampling.formatEstimate(*self.getEstimatedSessionCount())))
         print()
         return
     
@@ -68,6 +98,18 @@ class SessionTracker:
         # get a count of all sessions processed so far
         return len(self.activeSessions) + len(self.oldSessions)
     
+    def getEstimatedSessionCount(self):
+        # get an estimate of the count of sessions across all IP addresses (not just sampled ones)
+        # returns: (estimate, halfWidth) where the 95% confidence interval is estimate +/- halfWidth
+        
+        sessionsByIP = {}
+        for session in self.oldSessions + list(self.activeSessions.values()):
+            if session.ip in sessionsByIP:
+                sessionsByIP[session.ip] = sessionsByIP[session.ip] + 1
+            else:
+                sessionsByIP[session.ip] = 1
+        return sampling.estimateTotal(list(sessionsByIP.values()), self.sampleRate)
+    
     def getLongestSessions(self, num = 25):
         # get the top 'num' sessions sorted by duration from most to least
         self.finalize()
@@ -127,19 +169,36 @@ class SessionTracker:
 class Session:
     # Is: a group of hits from a single IP address that occurred with a gap between hits no larger
     #    than the given 'maxGap'
+    # Note: We can have millions of these, so they are kept compact:  no per-object __dict__, hit
+    #    times and areas in typed arrays, and areas and User-Agents as IDs into StringTables
+    #    shared across the SessionTracker.
 
-    def __init__ (self, maxGap):
+    __slots__ = ('maxGap', 'earliestTime', 'latestTime', 'hits', 'areaIds', 'ip', 'cachedRobotScore',
+        'agentId', 'peakCache', 'areas', 'agents')
+
+    def __init__ (self, maxGap, areas = None, agents = None):
+        # constructor; 'areas' and 'agents' are StringTables to use for data areas and User-Agents
+        #    (if not specified, this Session gets its own)
         self.maxGap = maxGap        # maximum gap (in seconds) between hits for them to be part of the same session
         self.earliestTime = None    # earliest time (in seconds) for a hit in this session
         self.latestTime = None      # latest time (in seconds) for a hit in this session
-        self.hits = []
-        self.hitsByArea = {}
+        self.hits = array('d')      # time (in seconds) of each hit
+        self.areaIds = array('I')   # area ID of each hit (parallel to 'hits')
         self.ip = None
         self.cachedRobotScore = None
-        self.userAgent = None
-        self.peakCache = {}         # maps from number of seconds to peak traffic for that size time slice
+        self.agentId = None
+        self.peakCache = None       # maps from number of seconds to peak traffic for that size time slice
+        self.areas = areas or StringTable()
+        self.agents = agents or StringTable()
         return
     
+    @property
+    def userAgent (self):
+        # User-Agent string from the first hit in this session
+        if self.agentId == None:
+            return None
+        return self.agents.getString(self.agentId)
+
     def getExpirationTime (self):
         # return the time (in seconds) at which a hit can no longer be part of this session
         return self.latestTime + self.maxGap
@@ -172,18 +231,13 @@ class Session:
             self.ip = entry.ip
             self.earliestTime = entryTime
             self.latestTime = entryTime
-            self.userAgent = entry.userAgent
+            self.agentId = self.agents.getId(entry.userAgent)
         else:
             self.earliestTime = min(entryTime, self.earliestTime)
             self.latestTime = max(entryTime, self.latestTime)
             
         self.hits.append(entryTime)
-
-        area = entry.area()
-        if area not in self.hitsByArea:
-            self.hitsByArea[area] = 1
-        else:
-            self.hitsByArea[area] = 1 + self.hitsByArea[area]
+        self.areaIds.append(self.areas.getId(entry.area()))
         return
     
     def getDuration (self):
@@ -200,7 +254,18 @@ class Session:
     def getTotalHitsByArea (self):
         # get the number of hits broken down by content area
         # returns:  { 'area1' : hit count, 'area2' : hit count, ... }
-        return self.hitsByArea
+        hitsByArea = {}
+        for areaId in self.areaIds:
+            area = self.areas.getString(areaId)
+            if area not in hitsByArea:
+                hitsByArea[area] = 1
+            else:
+                hitsByArea[area] = 1 + hitsByArea[area]
+        return hitsByArea
+    
+    def getAreaCount (self):
+        # get the number of different content areas hit in this session
+        return len(set(self.areaIds))
     
     def getHitsPerMinute (self):
         # return the average number of hits per minute for the session (as a float)
@@ -215,6 +280,9 @@ class Session:
         if not self.hits:
             return 0.0
         
+        if self.peakCache == None:
+            self.peakCache = {}
+
         if seconds not in self.peakCache:
             bins = []       # each bin is [start time, end time, count of hits]
             for entryTime in self.hits:
@@ -251,6 +319,6 @@ class Session:
                 + 0.25 * scale(self.getPeakHitsPerMinute()) \
                 + 0.20 * scale(self.getTotalHits()) \
                 + 0.15 * scale(self.getDuration()) \
-                + 0.05 * scale(len(self.getTotalHitsByArea()))
+                + 0.05 * scale(self.getAreaCount())
 
         return self.cachedRobotScore